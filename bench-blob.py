@@ -0,0 +1,72 @@
+
+import struct
+import time
+
+from cStringIO import StringIO
+from pysteam.blob import Blob, scan_nodes, NODE_COLUMNS, BLOB_HEADER, NODE_HEADER
+from optparse import OptionParser
+
+parser = OptionParser()
+parser.add_option("-n", "--nodes", type="int", dest="nodes", default=2000000, help="Rough number of nodes in the synthetic blob.")
+parser.add_option("-f", "--fields", type="int", dest="fields", default=9, help="Nodes in each record's child blob.")
+parser.add_option("-z", "--compress", action="store_true", dest="compress", help="Compress the synthetic blob?")
+parser.add_option("-r", "--repeat", type="int", dest="repeat", default=3, help="Runs of each benchmark; the best one counts.")
+options, args = parser.parse_args()
+
+def make_blob(nodes):
+    # Pack a list of (key, data) pairs as an uncompressed blob.
+    body = "".join(NODE_HEADER.pack(len(key), len(data)) + key + data for key, data in nodes)
+    return BLOB_HEADER.pack(Blob.MAGIC, BLOB_HEADER.size + len(body), 0) + body
+
+# Records that look like CDR application records: a child blob of small
+# fields under a dword key.
+record = make_blob([(struct.pack("<L", i), "field %d" % i) for i in xrange(options.fields)])
+records = options.nodes // (options.fields + 1)
+data = make_blob([(struct.pack("<L", i), record) for i in xrange(records)])
+total = records*(options.fields + 1)
+
+if options.compress:
+    blob = Blob()
+    blob.parse(StringIO(data))
+    data = blob.serialize(True)
+
+def scan_all(buffer, offset, end):
+    # scan_nodes over every level; returns the number of nodes seen.
+    table = scan_nodes(buffer, offset, end)
+    count = len(table) // NODE_COLUMNS
+    for row in xrange(0, len(table), NODE_COLUMNS):
+        if table[row + 4]:
+            start = table[row + 2]
+            length, = struct.unpack_from("<l", buffer, start + 2)
+            count += scan_all(buffer, start + BLOB_HEADER.size, start + length)
+    return count
+
+def bench_scan():
+    if options.compress:
+        return 0
+    return scan_all(data, BLOB_HEADER.size, len(data))
+
+def bench_lazy():
+    # Only the top level is scanned, so only its nodes count.
+    blob = Blob()
+    blob.parse(StringIO(data), lazy=True)
+    return len(blob)
+
+def bench_eager():
+    blob = Blob()
+    blob.parse(StringIO(data))
+    return total
+
+print "%d nodes, %d bytes%s" % (total, len(data), " (compressed)" if options.compress else "")
+for name, bench, unit in (("scan", bench_scan, "nodes/s"),
+                          ("lazy", bench_lazy, "top-level nodes/s"),
+                          ("eager", bench_eager, "nodes/s")):
+    best = None
+    for i in xrange(options.repeat):
+        start = time.time()
+        count = bench()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    if count:
+        print "%-6s %8.3fs %12.0f %s" % (name, best, count / max(best, 1e-9), unit)
@@ -1,18 +1,24 @@
 
-from pysteam.fs.cachefile import CacheFile
+from pysteam.fs.cachefile import CacheFile, COPY_CHUNK
 from optparse import OptionParser
 
 parser = OptionParser()
 parser.add_option("-m", "--minimum", action="store_true", dest="minimum", help="Extract minimum footprint only?")
 parser.add_option("-o", "--output", dest="output", help="Output directory for extraction.")
+parser.add_option("-j", "--workers", type="int", dest="workers", default=1, help="Number of files to extract in parallel.")
+parser.add_option("-s", "--sequential", action="store_true", dest="sequential", help="Extract in on-disk sector order (one forward sweep)?")
+parser.add_option("-x", "--index", dest="index", help="Parsed index file to load the cache file's tables from (rebuilt when stale).")
+parser.add_option("-c", "--chunk-size", type="int", dest="chunk_size", default=COPY_CHUNK, help="Most bytes of a file to hold in memory at once while extracting.")
+parser.add_option("-i", "--incremental", action="store_true", dest="incremental", help="Only rewrite files (and chunks of files) that changed since the last extraction?")
+parser.add_option("-M", "--mmap", action="store_true", dest="mmap", help="Memory-map the cache file's data area?")
 options, args = parser.parse_args()
 
 cacheHandle = open(args[0],"rb")
-cacheFile = CacheFile.parse(cacheHandle)
+cacheFile = CacheFile.parse(cacheHandle, use_mmap=options.mmap, index_path=options.index)
 
 import os.path
 if options.minimum:
-    cacheFile.extract_minimum_footprint(os.path.realpath(options.output))
+    cacheFile.extract_minimum_footprint(os.path.realpath(options.output), workers=options.workers, disk_order=options.sequential, chunk_size=options.chunk_size, incremental=options.incremental)
 else:
-    cacheFile.extract(os.path.realpath(options.output))
+    cacheFile.extract(os.path.realpath(options.output), workers=options.workers, disk_order=options.sequential, chunk_size=options.chunk_size, incremental=options.incremental)
 cacheHandle.close()
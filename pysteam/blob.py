@@ -4,90 +4,404 @@ import pprint
 import struct
 import zlib
 
+from array import array
+from itertools import izip
 from cStringIO import StringIO
 
+# Blob, compressed blob and node headers.
+MAGIC_HEADER = struct.Struct("<H")
+BLOB_HEADER = struct.Struct("<HlL")
+COMPRESSED_HEADER = struct.Struct("<Hl4xl6x")
+NODE_HEADER = struct.Struct("<HL")
+
+# Row layout of a scan_nodes table: key offset, key size, data offset,
+# data size and whether the data is itself a blob.
+NODE_COLUMNS = 5
+
+def scan_nodes(buffer, offset, end):
+    # Walk the node headers between offset and end of buffer without
+    # copying any of it, into a flat table of NODE_COLUMNS wide rows.
+    table = array("l")
+    extend = table.extend
+    unpack_node = NODE_HEADER.unpack_from
+    unpack_magic = MAGIC_HEADER.unpack_from
+    magics = (Blob.MAGIC, Blob.COMPRESSED_MAGIC)
+
+    while offset < end:
+        key_size, data_size = unpack_node(buffer, offset)
+        key_offset = offset + 6
+        data_offset = key_offset + key_size
+        offset = data_offset + data_size
+        is_blob = data_size >= 2 and unpack_magic(buffer, data_offset)[0] in magics
+        extend((key_offset, key_size, data_offset, data_size, is_blob))
+
+    return table
+
 class Blob(object):
     MAGIC = 0x5001
     COMPRESSED_MAGIC = 0x4301
 
+    # zlib's default, as zlib.compress uses.
+    COMPRESSION_LEVEL = 6
+
     def __init__(self):
-        self.children = {}
+        # Nodes built so far, and the order of all keys (None until a scanned
+        # blob's keys are first needed).
+        self._children = {}
+        self._keys = []
         self.padding = 0
 
-    def parse(self, stream):
+        # The node we are the child of, and whether anything under us has
+        # changed since we were parsed.
+        self.owner = None
+        self.dirty = False
+
+        # Parsed blobs: the buffer holding the nodes, their scan_nodes table
+        # and key -> table row.
+        self.buffer = None
+        self.table = None
+        self.index = None
+
+    @property
+    def children(self):
+        for node in self:
+            pass
+        return self._children
+
+    def touch(self):
+        # Mark us and everything above us as needing to be serialized again.
+        if not self.dirty:
+            self.dirty = True
+            if self.owner is not None:
+                self.owner.touch()
+
+    def parse(self, stream, lazy=False):
+        # The blob's bytes are read once and scanned in place. With lazy,
+        # nodes are only built as they are asked for; see parse_buffer.
         mode, = struct.unpack("<H", stream.read(2))
         if mode == Blob.MAGIC:
             length = struct.unpack("<l", stream.read(4))[0] - 10
             self.padding, = struct.unpack("<L", stream.read(4))
 
-            end = stream.tell() + length
-            while stream.tell() < end:
-                node = BlobNode()
-                node.parse(stream)
-                self.children[node.key] = node
+            self._index_nodes(stream.read(length), 0, length)
+            if not lazy:
+                self._build_all()
 
             stream.seek(self.padding, os.SEEK_CUR)
 
         elif mode == Blob.COMPRESSED_MAGIC:
-            # If we are compressed, decompress and reparse.
+            # If we are compressed, inflate a window at a time into one
+            # buffer and scan the nested blob in place.
             compressed_len, decompressed_len = struct.unpack("<l4xl6x", stream.read(18))
 
-            # Read n bytes.
-            compressed_bytes = stream.read(compressed_len)
-            decompressed_bytes = zlib.decompress(compressed_bytes)
+            inflated = BlobInflateStream(stream, compressed_len)
+            self.parse_buffer(inflated.readall(decompressed_len))
+            if not lazy:
+                self._build_all()
 
-            self.parse(StringIO(decompressed_bytes))
+            # Step over anything the nested blob didn't need.
+            if inflated.remaining:
+                stream.seek(inflated.remaining, os.SEEK_CUR)
 
-    def serialize(self, compress=True):
-        mode = Blob.COMPRESSED_MAGIC if compress else Blob.MAGIC
-        data = StringIO()
+    def parse_buffer(self, buffer, offset=0):
+        # Lazily parse the blob at offset in buffer (a str, mmap or buffer
+        # object). Only the key / size headers of our own nodes are read;
+        # nodes are built on first access and nested blobs parsed the same
+        # way, over the same buffer, when their node's child is asked for.
+        mode, = MAGIC_HEADER.unpack_from(buffer, offset)
+        if mode == Blob.MAGIC:
+            mode, length, self.padding = BLOB_HEADER.unpack_from(buffer, offset)
+            self._index_nodes(buffer, offset + BLOB_HEADER.size, offset + length)
 
-        for node in self.children.itervalues():
-            data.write(node.serialize())
+        elif mode == Blob.COMPRESSED_MAGIC:
+            mode, compressed_len, decompressed_len = COMPRESSED_HEADER.unpack_from(buffer, offset)
+            start = offset + COMPRESSED_HEADER.size
+            inflated = BlobInflateStream(StringIO(buffer[start:start + compressed_len]), compressed_len)
+            self.parse_buffer(inflated.readall(decompressed_len))
+
+    def _index_nodes(self, buffer, offset, end):
+        self.buffer = buffer
+        self.table = scan_nodes(buffer, offset, end)
+        self._keys = None
+
+    def _load_keys(self):
+        # Keys are only sliced out of the buffer once a node is looked up
+        # (or added or removed) by key.
+        if self._keys is None:
+            buffer = self.buffer
+            table = self.table
+            self._keys = [buffer[table[row]:table[row] + table[row + 1]]
+                          for row in xrange(0, len(table), NODE_COLUMNS)]
+            self.index = dict(izip(self._keys, xrange(0, len(table), NODE_COLUMNS)))
+        return self._keys
+
+    def _build_node(self, key, row):
+        table = self.table
+        node = BlobNode(key, self, self.buffer, table[row + 2], table[row + 3], table[row + 4] != 0)
+        self._children[key] = node
+        return node
 
-        if compress:
-            data = zlib.compress(data.getvalue())
+    def _build_all(self):
+        # Eager parsing: every node of a freshly scanned blob, all the way
+        # down.
+        buffer = self.buffer
+        table = self.table
+        children = self._children
+        for row in xrange(0, len(table), NODE_COLUMNS):
+            key = buffer[table[row]:table[row] + table[row + 1]]
+            node = BlobNode(key, self, buffer, table[row + 2], table[row + 3], table[row + 4] != 0)
+            children[key] = node
+            if node.unparsed:
+                node.child._build_all()
+
+    def _iter_rows(self):
+        # (key, node or None, table row) in file order.
+        if self._keys is None:
+            buffer = self.buffer
+            table = self.table
+            children = self._children
+            for row in xrange(0, len(table), NODE_COLUMNS):
+                key = buffer[table[row]:table[row] + table[row + 1]]
+                yield key, children.get(key), row
         else:
-            data = data.getvalue()
+            for key in self._keys:
+                yield key, self._children.get(key), self.index.get(key) if self.index else None
+
+    def serialize(self, compress=True):
+        return "".join(self.serialize_pieces(compress))
+
+    def write(self, stream, compress=True):
+        stream.writelines(self.serialize_pieces(compress))
+
+    def serialize_pieces(self, compress=True):
+        # The serialized blob as a flat list of strings, in one pass over
+        # the tree; keys and data go in as they are, without copying.
+        pieces = []
+        size = self._serialize_into(pieces)
+        if not compress:
+            return pieces
+
+        compressor = zlib.compressobj(self.COMPRESSION_LEVEL)
+        compressed = [None]
+        for piece in pieces:
+            data = compressor.compress(piece)
+            if data:
+                compressed.append(data)
+        compressed.append(compressor.flush())
+
+        # Same layout parse() reads: the compressed length, the inflated
+        # length and the compression level.
+        compressed[0] = struct.pack("<HlLlLH", Blob.COMPRESSED_MAGIC,
+                                    sum(len(data) for data in compressed[1:]),
+                                    0, size, 0, self.COMPRESSION_LEVEL)
+        return compressed
+
+    def _serialize_into(self, pieces):
+        # Append our pieces and return their total size. The header needs
+        # the size of everything under it, so it is filled in afterwards.
+        header = len(pieces)
+        pieces.append(None)
+
+        length = 10
+        table = self.table
+        for key, node, row in self._iter_rows():
+            if node is not None:
+                length += node._serialize_into(pieces)
+            else:
+                # Never built, so the original bytes still stand.
+                start = table[row] - NODE_HEADER.size
+                end = table[row + 2] + table[row + 3]
+                pieces.append(self.buffer[start:end])
+                length += end - start
 
-        return struct.pack("<H", mode) + data + ("\0" * self.padding)
+        pieces[header] = BLOB_HEADER.pack(Blob.MAGIC, length, self.padding)
+        if self.padding:
+            pieces.append("\0" * self.padding)
+        return length + self.padding
 
     def __len__(self):
-        return len(self.children)
+        if self._keys is None:
+            return len(self.table) // NODE_COLUMNS
+        return len(self._keys)
 
     def __iter__(self):
-        return self.children.itervalues()
+        for key, node, row in self._iter_rows():
+            if node is None:
+                node = self._build_node(key, row)
+            yield node
 
     def __getitem__(self, key):
         if isinstance(key, int):
             key = struct.pack("<L", key)
-        return self.children[key]
+        node = self._children.get(key)
+        if node is None:
+            self._load_keys()
+            if self.index is None or key not in self.index:
+                raise KeyError(key)
+            node = self._build_node(key, self.index[key])
+        return node
+
+    def __setitem__(self, key, node):
+        if isinstance(key, int):
+            key = struct.pack("<L", key)
+        keys = self._load_keys()
+        if key not in self._children and not (self.index and key in self.index):
+            keys.append(key)
+        node.key = key
+        node.owner = self
+        node.touch()
+        self._children[key] = node
+        self.touch()
+
+    def __delitem__(self, key):
+        if isinstance(key, int):
+            key = struct.pack("<L", key)
+        keys = self._load_keys()
+        if key not in self._children and not (self.index and key in self.index):
+            raise KeyError(key)
+        self._children.pop(key, None)
+        if self.index:
+            self.index.pop(key, None)
+        keys.remove(key)
+        self.touch()
+
+class BlobInflateStream(object):
+    # Read-only stream over the next length bytes of zlib data in stream,
+    # holding at most about one WINDOW of compressed and of inflated data
+    # besides what has been read.
+    WINDOW = 0x10000
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+        self.inflater = zlib.decompressobj()
+
+    def _inflate(self):
+        # Next piece of inflated data, or "" at the end of the stream.
+        while True:
+            if self.inflater.unconsumed_tail:
+                data = self.inflater.decompress(self.inflater.unconsumed_tail, self.WINDOW)
+            elif self.remaining > 0:
+                compressed = self.stream.read(min(self.remaining, self.WINDOW))
+                if not compressed:
+                    raise IOError, "Compressed blob is truncated"
+                self.remaining -= len(compressed)
+                data = self.inflater.decompress(compressed, self.WINDOW)
+            else:
+                return self.inflater.flush()
+
+            if data:
+                return data
+
+    def readall(self, size):
+        # Everything left, inflated into one bytearray of the size the blob
+        # header gives (grown or cut if the header is wrong). Slicing the
+        # buffer object returned gives strings, as parse_buffer expects.
+        # The header is capped at what deflate can expand the rest to.
+        data = bytearray(max(0, min(size, self.remaining*1032)))
+        position = 0
+        while True:
+            piece = self._inflate()
+            if not piece:
+                break
+            data[position:position + len(piece)] = piece
+            position += len(piece)
+        del data[position:]
+        return buffer(data)
 
 class BlobNode(object):
-    def __init__(self):
-        self.key = None
-        self.data = None
-        self.child = None
+    __slots__ = ("key", "_data", "_child", "owner", "dirty", "buffer", "offset", "size", "unparsed")
+
+    def __init__(self, key=None, owner=None, buffer=None, offset=0, size=0, unparsed=False):
+        self.key = key
+        self._data = None
+        self._child = None
+
+        # The blob we are in, and whether we changed since we were parsed.
+        # Until we do, our data is still our serialized child and is written
+        # out as it is.
+        self.owner = owner
+        self.dirty = buffer is None
+
+        # Nodes of parsed blobs: where the data lies in the blob's buffer,
+        # and whether it holds a blob not parsed yet. data is sliced out and
+        # child parsed only when asked for.
+        self.buffer = buffer
+        self.offset = offset
+        self.size = size
+        self.unparsed = unparsed
+
+    def _get_data(self):
+        if self._data is None and self.buffer is not None:
+            self._data = self.buffer[self.offset:self.offset + self.size]
+        return self._data
+
+    def _set_data(self, data):
+        # New raw data replaces any child blob.
+        self._data = data
+        self._child = None
+        self.buffer = None
+        self.unparsed = False
+        self.touch()
+
+    data = property(_get_data, _set_data)
+
+    def _get_child(self):
+        if self.unparsed:
+            self.unparsed = False
+            self._child = Blob()
+            self._child.owner = self
+            self._child.parse_buffer(self.buffer, self.offset)
+        return self._child
+
+    def _set_child(self, child):
+        self._get_child()
+        self._child = child
+        if child is not None:
+            child.owner = self
+        self.touch()
+
+    child = property(_get_child, _set_child)
+
+    def touch(self):
+        if not self.dirty:
+            self.dirty = True
+            if self.owner is not None:
+                self.owner.touch()
 
     def parse(self, stream):
         # These are defined internally.
-        key_size, data_size = struct.unpack("<HL", stream.read(6))
+        key_size, data_size = NODE_HEADER.unpack(stream.read(NODE_HEADER.size))
         self.key = stream.read(key_size)
-        self.data = stream.read(data_size)
+        self._data = stream.read(data_size)
+        self.dirty = False
         if data_size < 2:
             return
 
-        magic, = struct.unpack("<H", self.data[:2])
+        magic, = MAGIC_HEADER.unpack_from(self._data)
         if magic in (Blob.MAGIC, Blob.COMPRESSED_MAGIC):
-            self.child = Blob()
-            self.child.parse(StringIO(self.data))
+            self._child = Blob()
+            self._child.owner = self
+            self._child.parse(StringIO(self._data))
 
     def serialize(self):
-        if self.child is not None:
-            data = self.child.serialize(False)
+        pieces = []
+        self._serialize_into(pieces)
+        return "".join(pieces)
+
+    def _serialize_into(self, pieces):
+        header = len(pieces)
+        pieces.append(None)
+        pieces.append(self.key)
+
+        if self.dirty and self.child is not None:
+            size = self.child._serialize_into(pieces)
         else:
-            data = self.data
-        return struct.pack("<HL", len(self.key), len(data)) + self.key + data
+            size = len(self.data)
+            pieces.append(self.data)
+
+        pieces[header] = struct.pack("<HL", len(self.key), size)
+        return 6 + len(self.key) + size
 
     def __len__(self):
         if self.child is not None:
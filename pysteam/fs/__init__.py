@@ -2,6 +2,12 @@
 import os
 
 class DirectoryFile(object):
+    # Packages create these by the hundred thousand; keep them small.
+    __slots__ = ("folder", "name", "package",
+                 # Filled in by CacheFile.
+                 "_manifest_entry", "item_size", "index", "sectors", "num_of_blocks",
+                 "is_fragmented", "is_user_config", "is_minimum_footprint")
+
     def __init__(self, folder, name="", package=None):
         self.folder = folder
         self.name = name
@@ -13,8 +19,8 @@ class DirectoryFile(object):
     def open(self, mode="rb"):
         return self.package._open_file(self, mode)
 
-    def extract(self, where, keep_folder_structure=True):
-        return self.package._extract_file(self, where, keep_folder_structure)
+    def extract(self, where, keep_folder_structure=True, **kwargs):
+        return self.package._extract_file(self, where, keep_folder_structure, **kwargs)
 
     def is_file(self):
         # Yep. We are a file. Peek at the class name if you need to.
@@ -31,6 +37,10 @@ class DirectoryFile(object):
         return os.path.join(self.folder.sys_path(), self.name)
 
 class DirectoryFolder(object):
+    __slots__ = ("owner", "name", "package", "items",
+                 # Filled in by CacheFile.
+                 "_manifest_entry", "item_size", "index")
+
     def __init__(self, parent, name="", package=None):
         self.owner = parent
         self.name = name
@@ -49,8 +59,8 @@ class DirectoryFolder(object):
     def size(self):
         return sum(i.size() for i in self.items)
 
-    def extract(self, where, recursive=False, keep_folder_structure=True, filter=None):
-        return self.package._extract_folder(self, where, recursive, keep_folder_structure, filter)
+    def extract(self, where, recursive=False, keep_folder_structure=True, filter=None, **kwargs):
+        return self.package._extract_folder(self, where, recursive, keep_folder_structure, filter, **kwargs)
 
     def is_file(self):
         return False
@@ -1,10 +1,21 @@
 
 import struct
+import sys
 import os
+import io
+import mmap
+import threading
+import json
 
 from pysteam.fs import DirectoryFolder, DirectoryFile, FilesystemPackage
 from math import ceil
-from zlib import adler32
+from bisect import bisect_right
+from array import array
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
+from itertools import izip
+from zlib import adler32, crc32
 
 #try:
 from cStringIO import StringIO
@@ -13,14 +24,155 @@ from cStringIO import StringIO
 
 STEAM_TERMINATOR = "\\" # Hasta la vista, baby.
 
+# Layout version of verify()'s sidecar cache.
+VERIFY_CACHE_VERSION = 1
+
+# Output files kept open at once by a disk order extraction sweep.
+MAX_OPEN_FILES = 64
+
+# Default for the largest piece of a file extraction holds in memory at
+# once when the kernel can't copy it for us (rounded to whole sectors).
+COPY_CHUNK = 0x100000
+
 MAX_FILENAME = 0
 
+def unpack_array(typecode, data):
+    # Decode a whole table of little endian integers in one step.
+    values = array(typecode)
+    values.fromstring(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
 def unpack_dword_list(stream, count):
-    return list(struct.unpack("<%dL" % count, stream.read(count*4)))
+    return unpack_array("I", stream.read(count*4))
 
 def pack_dword_list(list):
     return struct.pack("<%dL" % len(list), *list)
 
+def write_file(path, data):
+    # Write a new file and move it over the old one, so an interrupted
+    # run never leaves a half written file behind.
+    temp = path + ".tmp"
+    try:
+        handle = open(temp, "wb")
+        try:
+            handle.write(data)
+        finally:
+            handle.close()
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(temp, path)
+    except (IOError, OSError):
+        if os.path.exists(temp):
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+        raise
+
+def libc_function(name, restype, *argtypes):
+    # A libc call through ctypes, or None where libc doesn't have it.
+    try:
+        function = getattr(libc, name)
+    except AttributeError:
+        return None
+    function.restype = restype
+    function.argtypes = argtypes
+    return function
+
+# Python 2's os module has neither copy_file_range nor sendfile, so on
+# Linux they are called straight from libc. Elsewhere (or without ctypes)
+# extraction copies through memory.
+try:
+    if not sys.platform.startswith("linux"):
+        raise ImportError
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+except (ImportError, OSError):
+    libc = None
+
+if libc is not None:
+    offset_pointer = ctypes.POINTER(ctypes.c_int64)
+    copy_file_range = libc_function("copy_file_range", ctypes.c_ssize_t, ctypes.c_int, offset_pointer,
+                                    ctypes.c_int, offset_pointer, ctypes.c_size_t, ctypes.c_uint)
+    sendfile = libc_function("sendfile64", ctypes.c_ssize_t, ctypes.c_int, ctypes.c_int,
+                             offset_pointer, ctypes.c_size_t)
+else:
+    copy_file_range = sendfile = None
+
+KERNEL_COPY = copy_file_range is not None or sendfile is not None
+
+def copy_range(source, target, source_offset, target_offset, size):
+    # Copy between two descriptors inside the kernel, with copy_file_range
+    # or failing that sendfile. Returns the bytes copied, which falls short
+    # of size when neither could do (all of) it, e.g. across filesystems on
+    # older kernels. Both leave the source's file position alone.
+    copied = 0
+
+    if copy_file_range is not None:
+        source_position = ctypes.c_int64(source_offset)
+        target_position = ctypes.c_int64(target_offset)
+        while copied < size:
+            count = copy_file_range(source, ctypes.byref(source_position),
+                                    target, ctypes.byref(target_position), size - copied, 0)
+            if count <= 0:
+                break
+            copied += count
+
+    if copied < size and sendfile is not None:
+        # sendfile writes at the target's own position.
+        os.lseek(target, target_offset + copied, os.SEEK_SET)
+        source_position = ctypes.c_int64(source_offset + copied)
+        while copied < size:
+            count = sendfile(target, source, ctypes.byref(source_position), size - copied)
+            if count <= 0:
+                break
+            copied += count
+
+    return copied
+
+def pack_array(values):
+    # Inverse of unpack_array.
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
+
+def chunk_checksum(data):
+    # What the checksum map holds for each compression_block_size chunk.
+    return (adler32(data, 0) ^ crc32(data, 0)) & 0xFFFFFFFF
+
+def chunk_signature(pieces, checksum):
+    # Identifies which sectors a chunk lives in and what it should hash to.
+    values = [checksum]
+    for piece in pieces:
+        values.extend(piece)
+    return crc32(struct.pack("<%dL" % len(values), *values)) & 0xFFFFFFFF
+
+# (cache file, verified, unchanged) for verify()'s worker processes, set
+# just before they are forked so the parsed tables come along for free.
+_verify_job = None
+
+def _verify_init():
+    # Each worker reads through a handle of its own; a forked descriptor
+    # shares its file position with the parent.
+    cache = _verify_job[0]
+    cache.stream = open(cache.stream.name, "rb")
+    cache.stream_lock = threading.Lock()
+
+def _verify_worker(index):
+    cache, verified, unchanged = _verify_job
+    return (index,) + cache._check_file(cache.manifest.manifest_entries[index], verified, unchanged)
+
+def column_property(name):
+    # Exposes one column of the owning table on its row views.
+    def get(self):
+        return self.owner.columns[name][self.index]
+    def set(self, value):
+        self.owner.columns[name][self.index] = value
+    return property(get, set)
+
 def raise_parse_error(func):
     def internal(self, *args, **kwargs):
         if not self.is_parsed:
@@ -39,6 +191,11 @@ def raise_ncf_error(func):
 
 class CacheFile(object):
 
+    # File states reported by verify()
+    VERIFY_OK         = "ok"
+    VERIFY_CORRUPT    = "corrupt"
+    VERIFY_INCOMPLETE = "incomplete"
+
     # Constructor
     def __init__(self):
         self.is_parsed = False
@@ -47,15 +204,23 @@ class CacheFile(object):
         self.manifest = None
         self.checksum_map = None
         self.data_header = None
+        self.data_map = None
+        self.data_view = None
+        self.extents = {}
+        self.sector_cache = None
+        self.stream_lock = threading.Lock()
+        self.thread_streams = None
         self.complete_total = 0
         self.complete_available = 0
+        self.lazy = False
         self.ncf_folder_pattern = "common/%(name)s"
 
     # Main methods.
 
     @classmethod
-    def parse(cls, stream):
+    def parse(cls, stream, use_mmap=False, lazy=False, index_path=None, cache_size=0):
         self = cls()
+        self.lazy = lazy
 
         try:
             self.filename = os.path.split(os.path.realpath(stream.name))[1]
@@ -68,35 +233,27 @@ class CacheFile(object):
         self.header.parse(stream.read(44))
         self.header.validate()
 
-        if self.is_gcf():
-
-            # Block Entries
-            self.blocks = CacheFileBlockAllocationTable(self)
-            self.blocks.parse(stream)
-            self.blocks.validate()
-
-            # Allocation Table
-            self.alloc_table = CacheFileAllocationTable(self)
-            self.alloc_table.parse(stream)
-            self.alloc_table.validate()
-
-        # Manifest
-        self.manifest = CacheFileManifest(self)
-        self.manifest.parse(stream)
-        self.manifest.validate()
-
-        # Checksum Map
-        self.checksum_map = CacheFileChecksumMap(self)
-        self.checksum_map.parse(stream)
-        self.checksum_map.validate()
+        # An up to date parsed index saves decoding the tables again.
+        index = None
+        if index_path is not None:
+            index = CacheFileIndex(self)
+        if index is None or not index.load(index_path):
+            self._parse_tables(stream)
+            if index is not None:
+                index.save(index_path)
 
         if self.is_gcf():
-            # Data Header.
-            self.data_header = CacheFileSectorHeader(self)
-            self.data_header.parse(stream.read(24)) # size of BlockDataHeader (6 longs)
-            self.data_header.validate()
+            if use_mmap:
+                self._map_data()
+            elif cache_size > 0:
+                # Mapped data is already cached by the OS.
+                self.sector_cache = CacheFileSectorCache(self, cache_size)
 
         self.is_parsed = True
+        if lazy:
+            # Folders list their children on first use; complete_available is
+            # only tallied if someone asks for it.
+            self.complete_available = None
         self._read_directory()
         return self
 
@@ -135,6 +292,36 @@ class CacheFile(object):
 
     # Private Methods
 
+    def _parse_tables(self, stream):
+
+        if self.is_gcf():
+
+            # Block Entries
+            self.blocks = CacheFileBlockAllocationTable(self)
+            self.blocks.parse(stream)
+            self.blocks.validate()
+
+            # Allocation Table
+            self.alloc_table = CacheFileAllocationTable(self)
+            self.alloc_table.parse(stream)
+            self.alloc_table.validate()
+
+        # Manifest
+        self.manifest = CacheFileManifest(self)
+        self.manifest.parse(stream)
+        self.manifest.validate()
+
+        # Checksum Map
+        self.checksum_map = CacheFileChecksumMap(self)
+        self.checksum_map.parse(stream)
+        self.checksum_map.validate()
+
+        if self.is_gcf():
+            # Data Header.
+            self.data_header = CacheFileSectorHeader(self)
+            self.data_header.parse(stream.read(24)) # size of BlockDataHeader (6 longs)
+            self.data_header.validate()
+
     def _read_directory(self):
 
         if self.is_ncf():
@@ -152,38 +339,52 @@ class CacheFile(object):
         manifest_entry = self.manifest.manifest_entries[0]
 
         # Fill in root.
-        self.root = DirectoryFolder(self, package=package)
+        if self.lazy:
+            self.root = LazyDirectoryFolder(self, package=package, cache=self)
+        else:
+            self.root = DirectoryFolder(self, package=package)
         self.root.index = 0
         self.root._manifest_entry = manifest_entry
-        self._read_directory_table(self.root)
+        if not self.lazy:
+            self._read_directory_table(self.root)
 
     def _read_directory_table(self, folder):
         i = folder._manifest_entry.child_index
 
         while i != 0xFFFFFFFF and i != 0:
             manifest_entry = self.manifest.manifest_entries[i]
-            is_file = manifest_entry.directory_flags & CacheFileManifestEntry.FLAG_IS_FILE != 0
-
-            # Create our entry.
-            klass = DirectoryFile if is_file else DirectoryFolder
-            entry = klass(folder, manifest_entry.name, self)
-
-            entry._manifest_entry = manifest_entry
-            entry.item_size = manifest_entry.item_size
-            entry.index = manifest_entry.index
+            entry = self._read_entry(folder, manifest_entry)
 
             folder.items[entry.name] = entry
 
-            if is_file:
+            if entry.is_file():
                 # Make sure it's a GCF before we read.
                 if self.is_gcf():
-                    self._read_file_table(entry)
+                    available = self._read_file_table(entry)
+                    if not self.lazy:
+                        self.complete_available += available
 
-            else:
+            elif not self.lazy:
                 self._read_directory_table(entry)
 
             i = manifest_entry.next_index
 
+    def _read_entry(self, folder, manifest_entry):
+        is_file = manifest_entry.directory_flags & CacheFileManifestEntry.FLAG_IS_FILE != 0
+
+        # Create our entry.
+        if is_file:
+            entry = DirectoryFile(folder, manifest_entry.name, self)
+        elif self.lazy:
+            entry = LazyDirectoryFolder(folder, manifest_entry.name, self)
+        else:
+            entry = DirectoryFolder(folder, manifest_entry.name, self)
+
+        entry._manifest_entry = manifest_entry
+        entry.item_size = manifest_entry.item_size
+        entry.index = manifest_entry.index
+        return entry
+
     @raise_ncf_error
     def _read_file_table(self, entry):
 
@@ -194,6 +395,9 @@ class CacheFile(object):
         # Number of blocks in this entry.
         entry.num_of_blocks = ceil(float(entry.size()) / float(self.data_header.sector_size))
 
+        # Returns the amount of data we have for this file.
+        available = 0
+
         for block in entry._manifest_entry.blocks:
             if block is None:
                 entry.sectors = []
@@ -203,10 +407,30 @@ class CacheFile(object):
                 entry.is_fragmented = block.is_fragmented
                 entry.sectors = block.sectors
 
-            self.complete_available += block.file_data_size
+            available += block.file_data_size
 
         entry.is_user_config = entry.index in self.manifest.user_config_entries
         entry.is_minimum_footprint = entry.index in self.manifest.minimum_footprint_entries
+        return available
+
+    def _find_manifest_entry(self, names):
+        # Resolve a list of path components to a manifest entry by walking
+        # the sibling lists down from the root, comparing names without case.
+        # The manifest's hash table isn't used: its hash and bucket layout
+        # haven't been checked against a real cache file.
+        entries = self.manifest.manifest_entries
+        entry = entries[0]
+        for name in names:
+            name = name.lower()
+            i = entry.child_index
+            while i != 0xFFFFFFFF and i != 0:
+                if entries[i].name.lower() == name:
+                    break
+                i = entries[i].next_index
+            else:
+                return None
+            entry = entries[i]
+        return entry
 
     @raise_ncf_error
     def _merge_file_blocks(self, entry):
@@ -229,8 +453,241 @@ class CacheFile(object):
             # Set the link from the last sector in the previous block to the first sector in this block.
             self.alloc_table[sector_index] = block.first_sector_index
 
+    @raise_ncf_error
+    def _map_data(self):
+        # Map the whole file read-only; sectors are then sliced out of the
+        # data area without a seek + read (and a fresh string) per sector.
+        self.data_map = mmap.mmap(self.stream.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.data_view = memoryview(self.data_map)[self.data_header.first_sector_offset:]
+        except TypeError:
+            # Python 2's mmap only has the old buffer interface.
+            self.data_view = None
+
     # Internal methods.
 
+    def _read_data(self, index, size, skip=0):
+        # Read size bytes starting skip bytes into sector index.
+        offset = self.data_header.sector_size*index + skip
+        if self.data_map is None:
+            return self._pread(self.data_header.first_sector_offset + offset, size)
+        if self.data_view is not None:
+            return self.data_view[offset:offset + size]
+        return buffer(self.data_map, self.data_header.first_sector_offset + offset, size)
+
+    def _read_cached(self, index, size):
+        # _read_data for streams, through the shared sector cache if any.
+        if self.sector_cache is None:
+            return self._read_data(index, size)
+        return self.sector_cache.read(index, size)
+
+    def _pread(self, offset, size):
+        # Positional read that leaves the shared stream position alone where
+        # the platform allows it, so concurrent readers don't race.
+        if hasattr(os, "pread"):
+            return os.pread(self.stream.fileno(), size, offset)
+        if self.thread_streams is not None:
+            stream = self._thread_stream()
+            stream.seek(offset, os.SEEK_SET)
+            return stream.read(size)
+        with self.stream_lock:
+            self.stream.seek(offset, os.SEEK_SET)
+            return self.stream.read(size)
+
+    def _thread_stream(self):
+        # This thread's own handle on the cache file, opened on first use.
+        local, handles = self.thread_streams
+        stream = getattr(local, "stream", None)
+        if stream is None:
+            stream = local.stream = open(self.stream.name, "rb")
+            handles.append(stream)
+        return stream
+
+    def _open_thread_streams(self):
+        # Without os.pread, parallel extraction gives each worker a handle
+        # of its own instead of having them all take turns on stream_lock.
+        if hasattr(os, "pread") or self.data_map is not None or self._stream_path() is None:
+            return False
+        self.thread_streams = (threading.local(), [])
+        return True
+
+    def _close_thread_streams(self):
+        local, handles = self.thread_streams
+        self.thread_streams = None
+        for stream in handles:
+            stream.close()
+
+    @raise_ncf_error
+    def _get_extents(self, manifest_entry):
+        # Flat (file offset, first sector, byte length) triples, one per run
+        # of physically contiguous sectors, built on first use per file.
+        try:
+            return self.extents[manifest_entry.index]
+        except KeyError:
+            pass
+
+        sector_size = self.data_header.sector_size
+        alloc = self.alloc_table.entries
+        terminator = self.alloc_table.terminator
+        extents = array("L")
+
+        for block in manifest_entry.blocks:
+            offset = block.file_data_offset
+            end = offset + block.file_data_size
+            sector = block._first_sector_index
+
+            while offset < end and sector != terminator:
+                run_offset, run_sector = offset, sector
+                while True:
+                    offset += sector_size
+                    next_sector = alloc[sector]
+                    if offset >= end or next_sector != sector + 1:
+                        break
+                    sector = next_sector
+                length = min(offset, end) - run_offset
+
+                # Blocks often continue right where the previous one ended.
+                if extents and extents[-3] + extents[-1] == run_offset and extents[-1] % sector_size == 0 and \
+                   extents[-2] + extents[-1] // sector_size == run_sector:
+                    extents[-1] += length
+                else:
+                    extents.extend((run_offset, run_sector, length))
+
+                sector = next_sector
+
+        self.extents[manifest_entry.index] = extents
+        return extents
+
+    def _chunk_layouts(self, manifest_entry, chunk_size):
+        # Yields, for each chunk_size chunk of the file (the last one short),
+        # the (sector, skip, size) pieces of the data area it is stored in.
+        sector_size = self.data_header.sector_size
+        extents = self._get_extents(manifest_entry)
+        pieces = []
+        pending_size = 0
+
+        for i in xrange(0, len(extents), 3):
+            offset, sector, length = extents[i:i+3]
+            position = 0
+            while position < length:
+                size = min(chunk_size - pending_size, length - position)
+                skip_sectors, skip = divmod(position, sector_size)
+                pieces.append((sector + skip_sectors, skip, size))
+                pending_size += size
+                position += size
+                if pending_size == chunk_size:
+                    yield pieces
+                    pieces = []
+                    pending_size = 0
+
+        if pieces:
+            yield pieces
+
+    def _read_pieces(self, pieces):
+        data = [self._read_data(sector, size, skip) for sector, skip, size in pieces]
+        if len(data) == 1:
+            return data[0]
+        return "".join(str(x) for x in data)
+
+    def _iter_chunks(self, manifest_entry, chunk_size):
+        # Yields the file's data chunk_size bytes at a time, the last one short.
+        for pieces in self._chunk_layouts(manifest_entry, chunk_size):
+            yield self._read_pieces(pieces)
+
+    def _manifest_path(self, manifest_entry):
+        # Same as path() on the matching DirectoryFile.
+        entries = self.manifest.manifest_entries
+        names = []
+        while True:
+            names.append(manifest_entry.name)
+            if manifest_entry.index == 0:
+                break
+            manifest_entry = entries[manifest_entry.parent_index]
+        return self._join_path(*reversed(names))
+
+    def _verify_file(self, manifest_entry, verified=None):
+        # Returns (state, signatures). signatures has one entry per chunk found
+        # good, identifying the sectors and checksum it was checked against;
+        # chunks whose signature is already in verified aren't read again.
+        extents = self._get_extents(manifest_entry)
+        if sum(extents[2::3]) < manifest_entry.item_size:
+            return CacheFile.VERIFY_INCOMPLETE, None
+
+        checksum_map = self.checksum_map
+        if manifest_entry.checksum_index >= len(checksum_map.entries):
+            # Nothing to check against.
+            return CacheFile.VERIFY_OK, None
+
+        count, first = checksum_map.entries[manifest_entry.checksum_index]
+        chunk_size = self.manifest.compression_block_size
+        if count*chunk_size < manifest_entry.item_size:
+            return CacheFile.VERIFY_CORRUPT, None
+
+        signatures = []
+        for i, pieces in enumerate(self._chunk_layouts(manifest_entry, chunk_size)):
+            checksum = checksum_map.checksums[first + i]
+            signature = chunk_signature(pieces, checksum)
+            if verified is None or i >= len(verified) or verified[i] != signature:
+                if chunk_checksum(self._read_pieces(pieces)) != checksum:
+                    return CacheFile.VERIFY_CORRUPT, None
+            signatures.append(signature)
+        return CacheFile.VERIFY_OK, signatures
+
+    def _check_file(self, manifest_entry, verified, unchanged):
+        # _verify_file, skipping files found good last time if nothing changed.
+        previous = verified.get(str(manifest_entry.index))
+        if unchanged and previous is not None:
+            return CacheFile.VERIFY_OK, previous
+        return self._verify_file(manifest_entry, previous)
+
+    def _verify_processes(self):
+        # Whether verify() can fork workers that reopen the cache file.
+        return hasattr(os, "fork") and self._stream_path() is not None
+
+    def _verify_cache_key(self):
+        # (size, mtime) of the cache file, if it is a real file.
+        try:
+            stat = os.fstat(self.stream.fileno())
+        except (AttributeError, ValueError, IOError):
+            return None
+        return [stat.st_size, stat.st_mtime]
+
+    def _load_verify_cache(self, path):
+        # Returns (verified, unchanged): the chunk signatures recorded by the
+        # last verify() of this same manifest, and whether the file looks
+        # untouched since then.
+        try:
+            handle = open(path, "rb")
+        except IOError:
+            return {}, False
+        try:
+            cache = json.load(handle)
+        except ValueError:
+            return {}, False
+        finally:
+            handle.close()
+
+        if cache.get("version") != VERIFY_CACHE_VERSION or cache.get("fingerprint") != self.manifest.fingerprint:
+            return {}, False
+
+        unchanged = cache.get("checksum") == self.header.checksum and \
+                    cache.get("stat") is not None and cache.get("stat") == self._verify_cache_key()
+        return cache.get("files", {}), unchanged
+
+    def _save_verify_cache(self, path, verified):
+        cache = dict(version=VERIFY_CACHE_VERSION,
+                     fingerprint=self.manifest.fingerprint,
+                     checksum=self.header.checksum,
+                     stat=self._verify_cache_key(),
+                     files=verified)
+
+        # Losing the sidecar only costs the next run time; the results of
+        # this one still go back to the caller.
+        try:
+            write_file(path, json.dumps(cache))
+        except (IOError, OSError):
+            pass
+
     def _join_path(self, *args):
         return STEAM_TERMINATOR.join(args)
 
@@ -246,36 +703,233 @@ class CacheFile(object):
 
     @raise_parse_error
     @raise_ncf_error
-    def _extract_folder(self, folder, where, recursive, keep_folder_structure, item_filter=None):
+    def _plan_extraction(self, folder, where, recursive, keep_folder_structure, item_filter=None):
+        # Returns (directories, files) to create, files being (entry, path) pairs.
+        # One pass over the tree: the filter runs once per file, and a folder is
+        # dropped again once its subtree turns out to have nothing left in it.
+        directories = []
+        files = []
+
+        def visit(folder, path):
+            if keep_folder_structure:
+                directories.append(os.path.join(where, path))
+
+            for entry in folder:
+                if entry.is_folder():
+                    if recursive:
+                        directory_count, file_count = len(directories), len(files)
+                        visit(entry, os.path.join(path, entry.name))
+                        # Don't bother creating the folder if no files are left after the filter.
+                        if item_filter is not None and len(files) == file_count:
+                            del directories[directory_count:]
+                elif (item_filter is None) or item_filter(entry):
+                    if keep_folder_structure:
+                        files.append((entry, os.path.join(where, path, entry.name)))
+                    else:
+                        files.append((entry, os.path.join(where, entry.name)))
+
+        visit(folder, folder.sys_path())
+        return directories, files
 
-        if keep_folder_structure:
+    @raise_parse_error
+    @raise_ncf_error
+    def _extract_folder(self, folder, where, recursive, keep_folder_structure, item_filter=None, workers=1, disk_order=False, chunk_size=COPY_CHUNK, incremental=False):
+        directories, files = self._plan_extraction(folder, where, recursive, keep_folder_structure, item_filter)
+
+        # Create every directory up front so file writes can run in any order.
+        for path in directories:
             try:
-                os.makedirs(os.path.join(where, folder.sys_path()))
+                os.makedirs(path)
             except os.error:
                 pass
 
-        # Loop over the folder and extract files and folders (if recursive)
-        for entry in folder:
-            # Don't bother recursing (and creating the folder) if no files are left after the filter.
-            if entry.is_folder() and recursive and ((item_filter is None) or (len([x for x in entry.all_files() if item_filter(x)]) > 0)):
-                self._extract_folder(entry, where, True, keep_folder_structure, item_filter)
-            elif entry.is_file():
-                if (item_filter is None) or item_filter(entry):
-                    self._extract_file(entry, where, keep_folder_structure)
+        if incremental:
+            stamp = self._extract_stamp()
+            write = lambda file, path: self._update_file(file, path, chunk_size, stamp)
+        else:
+            write = lambda file, path: self._write_file(file, path, chunk_size)
+
+        # Incremental runs mostly read, so they skip the disk order sweep.
+        if disk_order and not incremental:
+            self._write_files_in_disk_order(files, chunk_size)
+        elif workers > 1:
+            pool = ThreadPool(workers)
+            private = self._open_thread_streams()
+            try:
+                pool.map(lambda job: write(*job), files)
+            finally:
+                pool.close()
+                pool.join()
+                if private:
+                    self._close_thread_streams()
+        else:
+            for file, path in files:
+                write(file, path)
 
     @raise_parse_error
     @raise_ncf_error
-    def _extract_file(self, file, where, keep_folder_structure):
-        if keep_folder_structure:
-            fsHandle = open(os.path.join(where, file.sys_path()), "wb")
+    def _extract_file(self, file, where, keep_folder_structure, chunk_size=COPY_CHUNK, incremental=False):
+        path = self._extract_path(file, where, keep_folder_structure)
+        if incremental:
+            self._update_file(file, path, chunk_size, self._extract_stamp())
         else:
-            fsHandle = open(os.path.join(where, file.name), "wb")
-        cacheStream = self._open_file(file, "rb")
-        fsHandle.write(cacheStream.readall())
+            self._write_file(file, path, chunk_size)
+
+    def _extract_path(self, file, where, keep_folder_structure):
+        if keep_folder_structure:
+            return os.path.join(where, file.sys_path())
+        return os.path.join(where, file.name)
+
+    def _write_files_in_disk_order(self, files, chunk_size=COPY_CHUNK):
+        # Sort every extent of every file by physical sector and make one
+        # forward sweep over the data area, writing each run as it comes up.
+        runs = []
+        remaining = {}
+        for n, (file, path) in enumerate(files):
+            extents = self._get_extents(file._manifest_entry)
+            if not extents:
+                self._write_file(file, path, chunk_size)
+                continue
+            remaining[n] = len(extents) // 3
+            for i in xrange(0, len(extents), 3):
+                runs.append((extents[i+1], extents[i], extents[i+2], n))
+        runs.sort()
+
+        handles = OrderedDict()
+        started = set()
+        try:
+            for sector, offset, length, n in runs:
+                file, path = files[n]
+                handle = handles.pop(n, None)
+                if handle is None:
+                    if len(handles) >= MAX_OPEN_FILES:
+                        handles.popitem(last=False)[1].close()
+                    handle = open(path, "r+b" if n in started else "wb")
+                    started.add(n)
+                handles[n] = handle
+
+                self._copy_run(handle, offset, sector, length, chunk_size)
+
+                remaining[n] -= 1
+                if not remaining[n]:
+                    handle.truncate(file.item_size)
+                    handles.pop(n).close()
+        finally:
+            for handle in handles.itervalues():
+                handle.close()
+
+    def _write_file(self, file, path, chunk_size=COPY_CHUNK):
+        fsHandle = open(path, "wb")
+
+        # One copy per run of contiguous sectors.
+        extents = self._get_extents(file._manifest_entry)
+        for i in xrange(0, len(extents), 3):
+            offset, sector, length = extents[i:i+3]
+            self._copy_run(fsHandle, offset, sector, length, chunk_size)
+        fsHandle.truncate(file.item_size)
 
-        cacheStream.close()
         fsHandle.close()
 
+    def _copy_run(self, handle, offset, sector, length, chunk_size=COPY_CHUNK, skip=0):
+        # Write length bytes from skip bytes into sector on to handle at
+        # offset. The kernel moves what it can; the rest goes through memory
+        # chunk_size bytes at a time, whatever the size of the file.
+        sector_size = self.data_header.sector_size
+        chunk_size = max(sector_size, chunk_size - chunk_size % sector_size)
+
+        copied = 0
+        source = self._stream_fileno() if KERNEL_COPY else None
+        if source is not None:
+            handle.flush()
+            copied = copy_range(source, handle.fileno(),
+                                self.data_header.first_sector_offset + sector_size*sector + skip,
+                                offset, length)
+
+        handle.seek(offset + copied)
+        while copied < length:
+            size = min(chunk_size, length - copied)
+            handle.write(self._read_data(sector, size, skip + copied))
+            copied += size
+
+    def _extract_stamp(self):
+        # Modification time given to incrementally extracted files, so the
+        # next run can tell they came from this very cache file.
+        key = self._verify_cache_key()
+        if key is None:
+            return None
+        return key[1]
+
+    def _update_file(self, file, path, chunk_size=COPY_CHUNK, stamp=None):
+        # _write_file for incremental extraction. A target of the right size
+        # that carries our stamp is left alone; any other existing target
+        # only has the chunks that fail the checksum map rewritten.
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+
+        if stat is not None and stat.st_size == file.item_size and \
+           stamp is not None and abs(stat.st_mtime - stamp) < 0.001:
+            return
+
+        if stat is None or not self._patch_file(file._manifest_entry, path, chunk_size):
+            self._write_file(file, path, chunk_size)
+
+        if stamp is not None:
+            os.utime(path, (stamp, stamp))
+
+    def _patch_file(self, manifest_entry, path, chunk_size=COPY_CHUNK):
+        # Rewrite the chunks of an existing file that don't match the checksum
+        # map. Returns False if the file can't be checked that way.
+        extents = self._get_extents(manifest_entry)
+        if sum(extents[2::3]) < manifest_entry.item_size:
+            return False
+
+        checksum_map = self.checksum_map
+        if manifest_entry.checksum_index >= len(checksum_map.entries):
+            return False
+
+        count, first = checksum_map.entries[manifest_entry.checksum_index]
+        block_size = self.manifest.compression_block_size
+        if count*block_size < manifest_entry.item_size:
+            return False
+
+        handle = open(path, "r+b")
+        try:
+            handle.truncate(manifest_entry.item_size)
+            offset = 0
+            for i, pieces in enumerate(self._chunk_layouts(manifest_entry, block_size)):
+                size = sum(piece[2] for piece in pieces)
+                handle.seek(offset)
+                if chunk_checksum(handle.read(size)) != checksum_map.checksums[first + i]:
+                    position = offset
+                    for sector, skip, length in pieces:
+                        self._copy_run(handle, position, sector, length, chunk_size, skip)
+                        position += length
+                offset += size
+        finally:
+            handle.close()
+
+        return True
+
+    def _stream_fileno(self):
+        # The cache file's descriptor, or None for streams without one.
+        try:
+            return self.stream.fileno()
+        except (AttributeError, IOError, ValueError):
+            return None
+
+    def _stream_path(self):
+        # The cache file's path, or None for streams that can't be reopened.
+        if self._stream_fileno() is None:
+            return None
+        try:
+            if os.path.isfile(self.stream.name):
+                return self.stream.name
+        except (AttributeError, TypeError):
+            pass
+        return None
+
     # Public Methods
     def is_ncf(self):
         return self.header.is_ncf()
@@ -286,21 +940,130 @@ class CacheFile(object):
     @raise_parse_error
     @raise_ncf_error
     def complete_percent(self, range=100):
+        if self.complete_available is None:
+            self.complete_available = 0
+            for manifest_entry in self.manifest.manifest_entries:
+                if manifest_entry.directory_flags & CacheFileManifestEntry.FLAG_IS_FILE != 0:
+                    self.complete_available += sum(block.file_data_size for block in manifest_entry.blocks)
         return float(self.complete_available) / float(self.complete_total) * float(range)
 
     @raise_parse_error
     @raise_ncf_error
-    def extract(self, where, recursive=True, keep_folder_structure=True, filter=None):
-        self._extract_folder(self.root, where, recursive, keep_folder_structure, filter)
+    def verify(self, workers=1, progress=None, cache_path=None):
+        # Check every file against the checksum map. Returns {path: state} for
+        # the files that aren't VERIFY_OK; progress(path, state) is called as
+        # each file finishes.
+        #
+        # With cache_path, chunks found good are recorded in that sidecar file
+        # along with the sectors they were read from. If the cache file is
+        # unchanged since (same size, mtime and header checksum), files checked
+        # good last time are skipped outright; otherwise only chunks whose
+        # sectors or checksum changed in the allocation table are read again.
+        # Any change of manifest fingerprint discards the sidecar.
+        #
+        # With workers > 1 files are checked in that many forked processes,
+        # each with its own handle on the cache file. Streams that can't be
+        # reopened fall back to threads, which only overlap waiting on disk.
+        if cache_path is not None:
+            verified, unchanged = self._load_verify_cache(cache_path)
+        else:
+            verified, unchanged = {}, False
+
+        entries = self.manifest.manifest_entries
+        indices = [manifest_entry.index for manifest_entry in entries
+                   if manifest_entry.directory_flags & CacheFileManifestEntry.FLAG_IS_FILE != 0]
+
+        def check(index):
+            return (index,) + self._check_file(entries[index], verified, unchanged)
+
+        global _verify_job
+        if workers > 1 and self._verify_processes():
+            _verify_job = (self, verified, unchanged)
+            try:
+                pool = Pool(workers, _verify_init)
+            finally:
+                _verify_job = None
+            results = pool.imap_unordered(_verify_worker, indices)
+        elif workers > 1:
+            pool = ThreadPool(workers)
+            results = pool.imap_unordered(check, indices)
+        else:
+            pool = None
+            results = (check(index) for index in indices)
+
+        failed = {}
+        signatures = {}
+        try:
+            for index, state, file_signatures in results:
+                manifest_entry = entries[index]
+                path = self._manifest_path(manifest_entry)
+                if state != CacheFile.VERIFY_OK:
+                    failed[path] = state
+                elif file_signatures is not None:
+                    signatures[str(manifest_entry.index)] = file_signatures
+                if progress is not None:
+                    progress(path, state)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if cache_path is not None:
+            self._save_verify_cache(cache_path, signatures)
+        return failed
+
+    @raise_parse_error
+    @raise_ncf_error
+    def extract(self, where, recursive=True, keep_folder_structure=True, filter=None, workers=1, disk_order=False, chunk_size=COPY_CHUNK, incremental=False):
+        # With incremental, files already extracted from this cache file are
+        # skipped and older ones only have their changed chunks rewritten.
+        self._extract_folder(self.root, where, recursive, keep_folder_structure, filter, workers, disk_order, chunk_size, incremental)
 
     @raise_parse_error
     @raise_ncf_error
-    def extract_minimum_footprint(self, where, keep_folder_structure=True):
-        self._extract_folder(self.root, where, True, keep_folder_structure, lambda x:x.is_minimum_footprint and not (os.path.exists(os.path.join(where, x.sys_path())) and x.is_user_config))
+    def extract_minimum_footprint(self, where, keep_folder_structure=True, workers=1, disk_order=False, chunk_size=COPY_CHUNK, incremental=False):
+        self._extract_folder(self.root, where, True, keep_folder_structure, lambda x:x.is_minimum_footprint and not (os.path.exists(os.path.join(where, x.sys_path())) and x.is_user_config), workers, disk_order, chunk_size, incremental)
+
+    @raise_parse_error
+    def lookup(self, path):
+        # Find a file or folder by its full path ("\\" or "/" separated)
+        # straight from the manifest. Only a lazy CacheFile saves any work
+        # this way: without lazy=True, parse() has already built the whole
+        # tree and we just return the node it made.
+        names = [name for name in path.replace("/", STEAM_TERMINATOR).split(STEAM_TERMINATOR) if name]
+        manifest_entry = self._find_manifest_entry(names)
+        if manifest_entry is None:
+            raise KeyError(path)
+        if manifest_entry.index == 0:
+            return self.root
+
+        # The folders between the root and the entry, outermost first.
+        entries = self.manifest.manifest_entries
+        chain = []
+        i = manifest_entry.parent_index
+        while i != 0:
+            chain.append(entries[i])
+            i = entries[i].parent_index
+        chain.reverse()
+
+        if not self.lazy:
+            entry = self.root
+            for parent in chain + [manifest_entry]:
+                entry = entry.items[parent.name]
+            return entry
+
+        folder = self.root
+        for parent in chain:
+            folder = self._read_entry(folder, parent)
+
+        entry = self._read_entry(folder, manifest_entry)
+        if entry.is_file() and self.is_gcf():
+            self._read_file_table(entry)
+        return entry
 
     def open(self, filename, mode):
         # Use file.open instead of _open_file as we may be parsing an NCF
-        return self.root[filename].open(mode)
+        return self.lookup(filename).open(mode)
 
     def __len__(self):
         return len(self.root)
@@ -311,6 +1074,26 @@ class CacheFile(object):
     def __getitem__(self, name):
         return self.root[name]
 
+class LazyDirectoryFolder(DirectoryFolder):
+    __slots__ = ("cache", "_items")
+
+    def __init__(self, parent, name="", package=None, cache=None):
+        DirectoryFolder.__init__(self, parent, name, package)
+        self.cache = package if cache is None else cache
+        self._items = None
+
+    def _get_items(self):
+        # Fill in our children from the manifest the first time we're used.
+        if self._items is None:
+            self._items = {}
+            self.cache._read_directory_table(self)
+        return self._items
+
+    def _set_items(self, value):
+        self._items = value
+
+    items = property(_get_items, _set_items)
+
 class CacheFileHeader(object):
 
     def __init__(self, owner):
@@ -367,11 +1150,35 @@ class CacheFileHeader(object):
     def get_blocks_length(self):
         return self.sector_size * self.sector_count + 32 # Block Size * Block Count + Block Header
 
+class CacheFileEntryList(object):
+
+    # Row views over a table's columns, made on access.
+
+    def __init__(self, table, klass, count):
+        self.table = table
+        self.klass = klass
+        self.count = count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return self.klass(self.table, i)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self.klass(self.table, i)
+
 class CacheFileBlockAllocationTable(object):
 
     def __init__(self, owner):
         self.owner = owner
-        self.blocks = []
+        self.columns = {}
+        self.blocks = CacheFileEntryList(self, CacheFileBlockAllocationTableEntry, 0)
 
     def parse(self, stream):
 
@@ -385,12 +1192,19 @@ class CacheFileBlockAllocationTable(object):
          self.dummy4) = struct.unpack("<7L", stream.read(28))
         self.checksum = sum(ord(x) for x in stream.read(4))
 
-        # Block Entries
-        for i in xrange(self.block_count):
-            block = CacheFileBlockAllocationTableEntry(self)
-            block.index = i
-            block.parse(stream)
-            self.blocks.append(block)
+        # Block Entries, read in one go and split into columns.
+        data = stream.read(28*self.block_count)
+        halves = unpack_array("H", data)
+        words = unpack_array("I", data)
+        self.columns = dict(flags=halves[0::14],
+                            dummy1=halves[1::14],
+                            file_data_offset=words[1::7],
+                            file_data_size=words[2::7],
+                            first_sector_index=words[3::7],
+                            next_block_index=words[4::7],
+                            prev_block_index=words[5::7],
+                            manifest_index=words[6::7])
+        self.blocks = CacheFileEntryList(self, CacheFileBlockAllocationTableEntry, self.block_count)
 
     def serialize(self):
         data = struct.pack("<7L", self.block_count, self.blocks_used, self.last_block_used, self.dummy1, self.dummy2, self.dummy3, self.dummy4)
@@ -413,19 +1227,21 @@ class CacheFileBlockAllocationTableEntry(object):
     FLAG_DATA_2  = 0x200FC000
     FLAG_NO_DATA = 0x200F0000
 
-    def __init__(self, owner):
+    # A view of row index in the block table's columns.
+    __slots__ = ("owner", "index")
+
+    def __init__(self, owner, index):
         self.owner = owner
+        self.index = index
 
-    def parse(self, stream):
-        # Block Entry
-        (self.flags,
-         self.dummy1,
-         self.file_data_offset,
-         self.file_data_size,
-         self._first_sector_index,
-         self._next_block_index,
-         self._prev_block_index,
-         self.manifest_index) = struct.unpack("<2H6L", stream.read(28))
+    flags = column_property("flags")
+    dummy1 = column_property("dummy1")
+    file_data_offset = column_property("file_data_offset")
+    file_data_size = column_property("file_data_size")
+    _first_sector_index = column_property("first_sector_index")
+    _next_block_index = column_property("next_block_index")
+    _prev_block_index = column_property("prev_block_index")
+    manifest_index = column_property("manifest_index")
 
     def _get_sector_iterator(self):
         sector = self.first_sector
@@ -529,10 +1345,14 @@ class CacheFileManifest(object):
 
     def __init__(self, owner):
         self.owner = owner
-        self.manifest_entries = []
+        self.columns = {}
+        self.manifest_entries = CacheFileEntryList(self, CacheFileManifestEntry, 0)
         self.hash_table_keys = []
         self.hash_table_indices = []
 
+        # Contains NameOffset -> Name
+        self.names = {}
+
         # Contains ManifestIndex
         self.user_config_entries = []
 
@@ -563,19 +1383,22 @@ class CacheFileManifest(object):
         # 56 = size of header
         self.manifest_stream = StringIO(stream.read(self.binary_size-56))
 
-        # Manifest Entries
-        for i in xrange(self.node_count):
-            entry = CacheFileManifestEntry(self)
-            entry.index = i
-            # 28 = size of ManifestEntry
-            data = self.manifest_stream.read(28)
-            entry.parse(data)
-            self.manifest_entries.append(entry)
-            if (entry.directory_flags & CacheFileManifestEntry.FLAG_IS_FILE) != 0:
-                self.owner.complete_total += entry.item_size
+        # Manifest Entries, read in one go and split into columns.
+        # 28 = size of ManifestEntry
+        words = unpack_array("I", self.manifest_stream.read(28*self.node_count))
+        self.columns = dict(name_offset=words[0::7],
+                            item_size=words[1::7],
+                            checksum_index=words[2::7],
+                            directory_flags=words[3::7],
+                            parent_index=words[4::7],
+                            next_index=words[5::7],
+                            child_index=words[6::7])
+        self.manifest_entries = CacheFileEntryList(self, CacheFileManifestEntry, self.node_count)
+        self.owner.complete_total += self._count_files()
 
         # Name Table
         self.filename_table = self.manifest_stream.read(self.name_size)
+        self._split_names()
 
         # Info1 / HashTableKeys
         self.hash_table_keys = unpack_dword_list(self.manifest_stream, self.hash_table_key_count)
@@ -596,6 +1419,18 @@ class CacheFileManifest(object):
         # Manifest Map Entries (FirstBlockIndex)
         self.manifest_map_entries = unpack_dword_list(stream, self.node_count)
 
+    def _count_files(self):
+        return sum(size for size, flags in izip(self.columns["item_size"], self.columns["directory_flags"])
+                                         if flags & CacheFileManifestEntry.FLAG_IS_FILE != 0)
+
+    def _split_names(self):
+        # Split the name table once; entries look their names up by offset.
+        self.names = {}
+        offset = 0
+        for name in self.filename_table.split("\0"):
+            self.names[offset] = intern(name)
+            offset += len(name) + 1
+
     def serialize(self):
         # 56 = size of Header
         # 32 = size of ManifestEntry + size of DWORD for HashTableIndices
@@ -659,11 +1494,31 @@ class CacheFileManifestEntry(object):
     FLAG_IS_LAUNCH      = 0x00000002
     FLAG_IS_USER_CONFIG = 0x00000001
 
-    def __init__(self, owner):
+    # A view of row index in the manifest's columns.
+    __slots__ = ("owner", "index")
+
+    def __init__(self, owner, index):
         self.owner = owner
+        self.index = index
+
+    name_offset = column_property("name_offset")
+    item_size = column_property("item_size")
+    checksum_index = column_property("checksum_index")
+    directory_flags = column_property("directory_flags")
+    parent_index = column_property("parent_index")
+    next_index = column_property("next_index")
+    child_index = column_property("child_index")
 
     def _get_name(self):
-        return self.owner.filename_table[self.name_offset:].split("\0")[0]
+        try:
+            return self.owner.names[self.name_offset]
+        except KeyError:
+            # Offset into the middle of a name; share its tail.
+            table = self.owner.filename_table
+            name_end = table.find("\0", self.name_offset)
+            if name_end == -1:
+                name_end = len(table)
+            return intern(table[self.name_offset:name_end])
 
     def _set_name(self, value):
         name_end = self.owner.filename_table[self.name_offset:].find("\0")
@@ -683,15 +1538,6 @@ class CacheFileManifestEntry(object):
     def _set_first_block(self, value):
         self.owner.manifest_map_entries[self.index] = value
 
-    def parse(self, data):
-        (self.name_offset,
-         self.item_size,
-         self.checksum_index,
-         self.directory_flags,
-         self.parent_index,
-         self.next_index,
-         self.child_index) = struct.unpack("<7L", data)
-
     blocks = property(_get_block_iterator)
     first_block = property(_get_first_block, _set_first_block)
     name = property(_get_name, _set_name)
@@ -773,8 +1619,76 @@ class CacheFileSectorHeader(object):
     def calculate_checksum(self):
         return self.sector_count + self.sector_size + self.first_sector_offset + self.sectors_used
 
+class CacheFileSectorCache(object):
+
+    # Sectors read by a CacheFile's streams, shared between all of them and
+    # evicted least recently used first once they take up more than budget
+    # bytes. Safe to use from several threads.
+
+    def __init__(self, owner, budget):
+        self.owner = owner
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.sectors = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _get(self, index):
+        with self.lock:
+            data = self.sectors.pop(index, None)
+            if data is None:
+                self.misses += 1
+                return None
+            # Back on the most recently used end.
+            self.sectors[index] = data
+            self.hits += 1
+            return data
+
+    def _put(self, index, data):
+        with self.lock:
+            if index in self.sectors:
+                return
+            self.sectors[index] = data
+            self.size += len(data)
+            while self.size > self.budget and self.sectors:
+                self.size -= len(self.sectors.popitem(last=False)[1])
+
+    def read(self, index, size):
+        # Read size bytes starting at sector index, with one read per run of
+        # sectors that aren't cached.
+        sector_size = self.owner.data_header.sector_size
+        count = (size + sector_size - 1) // sector_size
+        sectors = [self._get(index + i) for i in xrange(count)]
+
+        i = 0
+        while i < count:
+            if sectors[i] is not None:
+                i += 1
+                continue
+            end = i
+            while end < count and sectors[end] is None:
+                end += 1
+            data = self.owner._read_data(index + i, (end - i)*sector_size)
+            for j in xrange(i, end):
+                sectors[j] = data[(j - i)*sector_size:(j - i + 1)*sector_size]
+                self._put(index + j, sectors[j])
+            i = end
+
+        data = "".join(sectors)
+        if len(data) > size:
+            data = data[:size]
+        return data
+
+    def clear(self):
+        with self.lock:
+            self.sectors.clear()
+            self.size = 0
+
 class CacheFileSector(object):
 
+    __slots__ = ("owner", "cache", "index", "_next_index")
+
     def __init__(self, owner, index):
         self.owner = owner
         self.cache = owner.owner.owner
@@ -790,95 +1704,358 @@ class CacheFileSector(object):
         self._next_index = value.index
 
     def get_data(self):
-        size = self.cache.data_header.sector_size
-        self.cache.stream.seek(self.cache.data_header.first_sector_offset + size*self.index, os.SEEK_SET)
-        return self.cache.stream.read(size)
+        return self.cache._read_data(self.index, self.cache.data_header.sector_size)
 
     next_sector = property(_get_next_sector, _set_next_sector)
 
-class GCFFileStream(object):
+class CacheFileIndex(object):
+
+    # Sidecar file holding a CacheFile's decoded tables and extent maps, so
+    # opening an unchanged cache file again skips parsing. It is keyed on the
+    # cache file's size, mtime and manifest fingerprint.
+
+    MAGIC = "PYSTEAMI"
+    VERSION = 2
+
+    # Magic, version, cache file size, mtime and fingerprint, size of the
+    # JSON fields and CRC32 of everything after the header.
+    HEADER = "<8sLQdLLl"
+
+    # Scalar fields kept for each table; the arrays are saved as sections.
+    FIELDS = {
+        "blocks": ("block_count", "blocks_used", "last_block_used", "dummy1", "dummy2", "dummy3", "dummy4", "checksum"),
+        "alloc_table": ("sector_count", "first_unused_entry", "is_long_terminator", "checksum", "terminator"),
+        "manifest": ("header_version", "application_id", "application_version", "node_count", "file_count",
+                     "compression_block_size", "binary_size", "name_size", "hash_table_key_count",
+                     "num_of_minimum_footprint_files", "num_of_user_config_files", "depot_info", "fingerprint",
+                     "checksum", "map_header_version", "map_dummy1"),
+        "checksum_map": ("header_version", "checksum_size", "format_code", "version", "file_id_count", "checksum_count"),
+        "data_header": ("application_version", "sector_count", "sector_size", "first_sector_offset", "sectors_used", "checksum"),
+    }
+
+    MANIFEST_LISTS = ("hash_table_keys", "hash_table_indices", "minimum_footprint_entries",
+                      "user_config_entries", "manifest_map_entries")
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    def _key(self):
+        # (size, mtime, manifest fingerprint) of the cache file, or None if
+        # the stream isn't a real file.
+        cache = self.owner
+        try:
+            stat = os.fstat(cache.stream.fileno())
+        except (AttributeError, ValueError, IOError):
+            return None
+
+        # The manifest follows the header, block entries and allocation table.
+        offset = 44
+        if cache.is_gcf():
+            offset += 32 + 28*cache.header.sector_count + 16 + 4*cache.header.sector_count
+        position = cache.stream.tell()
+        fingerprint, = struct.unpack("<L", cache._pread(offset + 48, 4))
+        cache.stream.seek(position, os.SEEK_SET)
+        return stat.st_size, stat.st_mtime, fingerprint
+
+    def _sections(self):
+        cache = self.owner
+        manifest = cache.manifest
+        sections = []
+
+        if cache.is_gcf():
+            for column, values in cache.blocks.columns.iteritems():
+                sections.append(("blocks." + column, values))
+            sections.append(("alloc_table.entries", cache.alloc_table.entries))
+
+        for column, values in manifest.columns.iteritems():
+            sections.append(("manifest." + column, values))
+        for name in CacheFileIndex.MANIFEST_LISTS:
+            sections.append(("manifest." + name, array("I", getattr(manifest, name))))
+        sections.append(("manifest.filename_table", array("B", manifest.filename_table)))
+
+        checksum_map = cache.checksum_map
+        sections.append(("checksum_map.entries", array("I", [value for entry in checksum_map.entries for value in entry])))
+        sections.append(("checksum_map.checksums", array("I", checksum_map.checksums)))
+        sections.append(("checksum_map.signature", array("B", checksum_map.signature)))
+
+        if cache.is_gcf():
+            # Resolve every file's extents now so they're stored too.
+            for manifest_entry in manifest.manifest_entries:
+                if manifest_entry.directory_flags & CacheFileManifestEntry.FLAG_IS_FILE != 0:
+                    cache._get_extents(manifest_entry)
+
+            # (manifest index, start, length) into one flat array.
+            extents_index = array("I")
+            extents_data = array("I")
+            for index, extents in cache.extents.iteritems():
+                extents_index.extend((index, len(extents_data), len(extents)))
+                extents_data.fromlist(extents.tolist())
+            sections.append(("extents.index", extents_index))
+            sections.append(("extents.data", extents_data))
+
+        return sections
+
+    def save(self, path):
+        key = self._key()
+        if key is None:
+            return
+
+        cache = self.owner
+        fields = {}
+        for name, attributes in CacheFileIndex.FIELDS.iteritems():
+            table = getattr(cache, name)
+            if table is not None:
+                fields[name] = dict((attribute, getattr(table, attribute)) for attribute in attributes)
+        fields = json.dumps(fields)
+
+        data = [fields]
+        for name, values in self._sections():
+            packed = pack_array(values)
+            data.append(struct.pack("<B", len(name)) + name + struct.pack("<cQ", values.typecode, len(packed)))
+            data.append(packed)
+
+        checksum = 0
+        for piece in data:
+            checksum = crc32(piece, checksum)
+        data.insert(0, struct.pack(CacheFileIndex.HEADER, CacheFileIndex.MAGIC, CacheFileIndex.VERSION,
+                                   key[0], key[1], key[2], len(fields), checksum))
+
+        # The index is only a shortcut; not being able to write it isn't
+        # worth failing the parse over.
+        try:
+            write_file(path, "".join(data))
+        except (IOError, OSError):
+            pass
+
+    def load(self, path):
+        # Fill in the owner's tables from path. Returns False, leaving the
+        # owner alone, if the index is missing, damaged or doesn't match the
+        # file.
+        key = self._key()
+        if key is None:
+            return False
+
+        try:
+            handle = open(path, "rb")
+        except IOError:
+            return False
+        try:
+            header_size = struct.calcsize(CacheFileIndex.HEADER)
+            if os.fstat(handle.fileno()).st_size < header_size:
+                return False
+            # Sections are decoded straight out of the mapping, each with a
+            # single copy into its array.
+            data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            handle.close()
+
+        try:
+            magic, version, size, mtime, fingerprint, fields_size, checksum = struct.unpack_from(CacheFileIndex.HEADER, data)
+            if (magic, version) != (CacheFileIndex.MAGIC, CacheFileIndex.VERSION) or (size, mtime, fingerprint) != key:
+                return False
+            if crc32(buffer(data, header_size), 0) != checksum:
+                return False
+
+            offset = header_size + fields_size
+            if offset > len(data):
+                return False
+            fields = json.loads(data[header_size:offset])
+
+            sections = {}
+            while offset < len(data):
+                name_size, = struct.unpack_from("<B", data, offset)
+                name = data[offset + 1:offset + 1 + name_size]
+                typecode, length = struct.unpack_from("<cQ", data, offset + 1 + name_size)
+                offset += 1 + name_size + 9
+                if offset + length > len(data):
+                    return False
+                sections[name] = unpack_array(typecode, buffer(data, offset, length))
+                offset += length
+
+            restored, extents = self._restore(fields, sections)
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError, struct.error):
+            return False
+        finally:
+            data.close()
+
+        # Everything decoded; only now hand it to the owner.
+        for name, value in restored.iteritems():
+            setattr(self.owner, name, value)
+        self.owner.extents.update(extents)
+        return True
+
+    def _restore(self, fields, sections):
+        # Rebuild the tables from a loaded index. Returns the owner's
+        # attributes and extent maps without setting them.
+        cache = self.owner
+        restored = {}
+        extents = {}
+
+        def table(name, klass):
+            result = klass(cache)
+            for attribute, value in fields[name].iteritems():
+                setattr(result, str(attribute), value)
+            return result
+
+        def columns(prefix):
+            return dict((name[len(prefix):], values) for name, values in sections.iteritems() if name.startswith(prefix))
+
+        if cache.is_gcf():
+            blocks = restored["blocks"] = table("blocks", CacheFileBlockAllocationTable)
+            blocks.columns = columns("blocks.")
+            blocks.blocks = CacheFileEntryList(blocks, CacheFileBlockAllocationTableEntry, blocks.block_count)
+
+            alloc_table = restored["alloc_table"] = table("alloc_table", CacheFileAllocationTable)
+            alloc_table.entries = sections["alloc_table.entries"]
+
+        manifest = restored["manifest"] = table("manifest", CacheFileManifest)
+        lists = CacheFileIndex.MANIFEST_LISTS + ("filename_table",)
+        manifest.columns = dict((name, values) for name, values in columns("manifest.").iteritems() if name not in lists)
+        for name in CacheFileIndex.MANIFEST_LISTS:
+            setattr(manifest, name, sections["manifest." + name])
+        manifest.filename_table = sections["manifest.filename_table"].tostring()
+        manifest.header_data = struct.pack("<14L", *[getattr(manifest, name) for name in CacheFileIndex.FIELDS["manifest"][:14]])
+        manifest.manifest_entries = CacheFileEntryList(manifest, CacheFileManifestEntry, manifest.node_count)
+        manifest._split_names()
+        restored["complete_total"] = cache.complete_total + manifest._count_files()
+
+        checksum_map = restored["checksum_map"] = table("checksum_map", CacheFileChecksumMap)
+        entries = sections["checksum_map.entries"]
+        checksum_map.entries = zip(entries[0::2], entries[1::2])
+        checksum_map.checksums = sections["checksum_map.checksums"]
+        checksum_map.signature = sections["checksum_map.signature"].tostring()
+
+        if cache.is_gcf():
+            restored["data_header"] = table("data_header", CacheFileSectorHeader)
+
+            extents_index = sections["extents.index"]
+            extents_data = sections["extents.data"]
+            for i in xrange(0, len(extents_index), 3):
+                index, start, length = extents_index[i:i+3]
+                extents[index] = array("L", extents_data[start:start + length])
+
+        return restored, extents
+
+class GCFFileStream(io.RawIOBase):
+
+    # Upper bound on the data fetched ahead of the current position.
+    READ_AHEAD = 0x10000
+
+    # Bytes readline() looks at first; doubled each time no newline turns up.
+    LINE_SCAN = 0x80
 
     def __init__(self, entry, owner, mode):
+        io.RawIOBase.__init__(self)
         self.entry = entry
         self.owner = owner
         self.mode = mode
-        self.sectors = [sect.get_data() for sect in self.entry.sectors]
 
-        self.position = 0
+        # Resolve the sector chain into the file's extent map up front;
+        # sector data itself is only read once read() gets to it.
+        self.extents = owner._get_extents(entry._manifest_entry)
+        self.offsets = self.extents[0::3]
 
-    # Iterator protocol.
-    def __iter__(self):
-        return self
+        # Read-ahead window: file offsets and data of the runs it holds.
+        self.window_offsets = []
+        self.window_data = []
 
-    def next(self):
-        return self.readline()
+        self.position = 0
 
-    # File protocol.
-    def flush(self):
-        # Nothing right now...
-        pass
+    # Iteration, close() and the context manager protocol come from
+    # io.IOBase.
+    def readable(self):
+        return self.is_read_mode()
 
-    def close(self):
-        # Nothing right now...
-        pass
+    def seekable(self):
+        return True
 
     def tell(self):
+        self._checkClosed()
         return self.position
 
-    def seek(self, offset, origin=None):
-
-        def err():
-            raise IOError, "Attempting to seek past end of file"
-
-        if origin == os.SEEK_SET or origin is None:
-            if offset > self.entry.item_size:
-                err()
-            self.position = offset
+    def seek(self, offset, origin=os.SEEK_SET):
+        self._checkClosed()
 
+        if origin == os.SEEK_SET:
+            position = offset
         elif origin == os.SEEK_CUR:
-            if offset + self.position > self.entry.item_size:
-                err()
-            self.position += offset
-
+            position = self.position + offset
         elif origin == os.SEEK_END:
-            if offset > self.entry.item_size or offset < 0:
-                err()
-            self.position = self.entry.item_size - offset
+            position = self.entry.item_size + offset
+        else:
+            raise ValueError, "Invalid seek origin"
+
+        if position < 0:
+            raise IOError, "Attempting to seek before start of file"
+
+        self.position = position
+        return position
 
     def readall(self):
-        return self.read(0)
+        return self.read()
 
-    def readline(self, size=-1):
+    def readinto(self, target):
+        self._checkClosed()
 
-        # Our count for the size parameter.
-        count = 0
-        # Strings are immutable... use a list
-        chars = []
+        if not self.is_read_mode():
+            raise AttributeError, "Cannot read from file with current mode"
 
-        lastchar = ""
+        # Text mode drops \r's, so the byte count differs from the file's.
+        if self.is_text_mode():
+            data = self.read(len(target))
+            target[:len(data)] = data
+            return len(data)
+
+        # Copy straight out of the read-ahead window.
+        done = 0
+        end = min(self.entry.item_size, self.position + len(target))
+
+        while self.position < end:
+            data, offset, size = self._locate(end - self.position)
+            if data is None:
+                target[done:done + size] = "\0" * size
+            elif isinstance(data, memoryview):
+                target[done:done + size] = data[offset:offset + size]
+            else:
+                target[done:done + size] = buffer(data, offset, size)
+            done += size
+            self.position += size
 
-        # Loop over our data one character at a time
-        # looking for line breaks
-        while True:
-            lastchar = self.read(1)
-            # If we get a CR
-            if lastchar == "\r":
-                # Strip out a LF if it comes next
-                if self.read(1) != "\n":
-                    self.position -= 1
-                break
-            elif lastchar == "\n":
-                break
-            elif count > size and size > 0:
-                # FIXME: What does the file module do when we have a size
-                # hint? Does it include newline in the count? What about
-                # CRLF? Does count as one or two chars?
+        return done
+
+    def readline(self, size=-1):
+        self._checkClosed()
+
+        if not self.is_read_mode():
+            raise AttributeError, "Cannot read from file with current mode"
+
+        end = self.entry.item_size
+        if size >= 0:
+            end = min(end, self.position + size)
+
+        # Scan the read-ahead window for the newline a piece at a time rather
+        # than a character at a time.
+        chunks = []
+        scan = self.LINE_SCAN
+
+        while self.position < end:
+            chunk = self._read_window(min(end - self.position, scan))
+            newline = chunk.find("\n")
+            if newline != -1:
+                chunk = chunk[:newline + 1]
+            chunks.append(chunk)
+            self.position += len(chunk)
+            if newline != -1:
                 break
+            scan = min(scan*2, self.READ_AHEAD)
+
+        line = "".join(chunks)
 
-            # Characters
-            chars.append(lastchar)
+        # Text mode; strip all \r's
+        if self.is_text_mode():
+            line = line.replace("\r", "")
 
-        return "".join(chars)
+        return line
 
     def readlines(self, sizehint=-1):
 
@@ -888,6 +2065,8 @@ class GCFFileStream(object):
 
         while True:
             data = self.readline()
+            if not data:
+                break
             lines.append(data)
             count += len(data)
             # If we have surpassed the sizehint, break
@@ -896,51 +2075,81 @@ class GCFFileStream(object):
 
         return lines
 
-    def read(self, size=0):
-
-        if not self.is_read_mode():
-            raise AttributeError, "Cannot read from file with current mode"
-
+    def _fill_window(self):
+        # Load up to READ_AHEAD bytes starting at the sector holding the
+        # current position, with a single read per extent.
         sector_size = self.owner.data_header.sector_size
-        sector_index, offset = divmod(self.position, sector_size)
+        count = len(self.offsets)
+        i = bisect_right(self.offsets, self.position) - 1
+        skip = 0
+        if i < 0:
+            i = 0
+        else:
+            skip = (self.position - self.offsets[i]) // sector_size
+
+        self.window_offsets = []
+        self.window_data = []
+        budget = self.READ_AHEAD
+
+        while i < count and budget > 0:
+            offset, sector, length = self.extents[3*i:3*i+3]
+            start = skip*sector_size
+            if start < length:
+                size = min(length - start, budget)
+                self.window_offsets.append(offset + start)
+                self.window_data.append(self.owner._read_cached(sector + skip, size))
+                budget -= size
+            i += 1
+            skip = 0
+
+    def _locate(self, size):
+        # Finds up to size bytes at the current position as (data, offset,
+        # length); data is None for a hole.
+        i = bisect_right(self.window_offsets, self.position) - 1
+        if i < 0 or self.position >= self.window_offsets[i] + len(self.window_data[i]):
+            self._fill_window()
+            i = bisect_right(self.window_offsets, self.position) - 1
+
+        if i >= 0:
+            start = self.window_offsets[i]
+            data = self.window_data[i]
+            if self.position < start + len(data):
+                offset = self.position - start
+                return data, offset, min(size, len(data) - offset)
+
+        # Sectors missing from an incomplete file read back as zeros.
+        following = bisect_right(self.offsets, self.position)
+        if following < len(self.offsets):
+            gap = self.offsets[following] - self.position
+        else:
+            gap = self.entry.item_size - self.position
+        return None, 0, min(size, gap)
 
-        if not self.sectors:
-            return ""
+    def _read_window(self, size):
+        # Returns at most size bytes at the current position.
+        data, offset, size = self._locate(size)
+        if data is None:
+            return "\0" * size
+        return data[offset:offset + size]
 
-        # Raise an error if we read past end of file.
-        if self.position + size > self.entry.item_size:
-            raise IOError, "Attempting to read past end of file"
+    def read(self, size=-1):
+        self._checkClosed()
 
-        # One file isn't always in just one block.
-        # We have to read multiple blocks sometimes in order to get a file.
-        read_pos = 0
+        if not self.is_read_mode():
+            raise AttributeError, "Cannot read from file with current mode"
+
+        # Reads stop short at the end of the file.
+        end = self.entry.item_size
+        if size is not None and size >= 0:
+            end = min(end, self.position + size)
 
         # Strings are immutable... use a list.
         data = []
 
-        if size < 1:
-
-            size = self.entry.item_size
-            # Get all the data by looping over the sectors.
-            for sector in self.sectors[sector_index:]:
-                data.append(sector[offset:min(sector_size, size)])
-                size -= sector_size
-                offset = 0
-
-        else:
-
-            while read_pos < size:
-
-                # It can't be bigger than the sector size or
-                # Take the minimum of the two and get the rest of the data on the next iteration.
-                read_length = min(size - read_pos, sector_size - offset)
-                data.append(self.sectors[sector_index][offset:read_length])
-
-                sector_index += 1
-                offset = 0
-
-            self.position += size
-            read_pos += size
+        while self.position < end:
+            chunk = self._read_window(end - self.position)
+            data.append(chunk)
+            self.position += len(chunk)
 
         # TYPE CHANGE!
         # Data - from list to str.